@@ -17,127 +17,402 @@ Description:        <Detects and computes the location and height of individual
                          rLiDAR: LiDAR Data Processing and Visualization.
                          R package version 0.1.5. https://CRAN.R-project.org/package=rLiDAR>
 """
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
 import arcpy
+import geopandas as gpd
+import numba
+import numpy as np
+import pandas as pd
+import pyogrio
+import rasterio
+from rasterio.windows import Window
+from scipy import ndimage
+import shapely
+from shapely.geometry import Polygon
+
+from PointAndSegWorkers import FASTMATH, FT_PER_M, GPU, MaskOutside, ProcessTile, ReadAndProcessTile, TraceSegments
+
+## CHM tile size (rounded down to whole on-disk blocks, with tile edges on block edges) and halo (1 cell for the 3x3 mean + 2 cells for the 5x5 max) in cells
+TILE_SIZE = 2048
+TILE_HALO = 3
+
+## Rows of canopy segments traced per worker task
+SEGMENT_BAND = 512
+
+
+## In-process script tools run inside ArcGISPro.exe, so spawned workers must start the environment's Python instead
+if sys.platform == "win32" and not os.path.basename(sys.executable).lower().startswith("python"):
+    multiprocessing.set_executable(os.path.join(sys.exec_prefix, "pythonw.exe"))
+
+
+def ProcessPool(maxWorkers):
+    """Process pool of up to maxWorkers spawned (not forked) workers, one per core, each running Numba kernels on one thread"""
+    return ProcessPoolExecutor(min(maxWorkers, os.cpu_count()), mp_context = multiprocessing.get_context("spawn"),
+                               initializer = numba.set_num_threads, initargs = (1,))
+
+
+def MapTasks(func, nTasks, *args):
+    """Map func over args in a process pool, or in this process when there is only one task or one core"""
+    if nTasks < 2 or os.cpu_count() < 2:
+        yield from map(func, *args)
+    else:
+        with ProcessPool(nTasks) as executor:
+            yield from executor.map(func, *args)
+
+
+def TileWindows(nRows, nCols, tileRows = TILE_SIZE, tileCols = TILE_SIZE, rowOffset = 0, colOffset = 0, halo = TILE_HALO):
+    """List (row0, row1, col0, col1) tile bounds and the same bounds grown by the halo, clipped to the raster
+
+    Tile edges fall on multiples of the tile size counted from rowOffset/colOffset cells before
+    the raster's first row/column, so the first row and column of tiles may be shorter.
+    """
+    windows = []
+    for top in range(-(rowOffset % tileRows), nRows, tileRows):
+        for left in range(-(colOffset % tileCols), nCols, tileCols):
+            row0, row1, col0, col1 = max(top, 0), min(top + tileRows, nRows), max(left, 0), min(left + tileCols, nCols)
+            windows.append(((row0, row1, col0, col1), (max(row0 - halo, 0), min(row1 + halo, nRows), max(col0 - halo, 0), min(col1 + halo, nCols))))
+    return windows
+
+
+def ClipWindow(transform, shape, bounds):
+    """Window of a raster (affine transform, (rows, cols) shape) covering bounds (xmin, ymin, xmax, ymax), snapped outward to whole cells like ExtractByMask"""
+    col0, row0 = ~transform * (bounds[0], bounds[3])
+    col1, row1 = ~transform * (bounds[2], bounds[1])
+    row0, col0 = max(int(np.floor(row0)), 0), max(int(np.floor(col0)), 0)
+    row1, col1 = min(int(np.ceil(row1)), shape[0]), min(int(np.ceil(col1)), shape[1])
+    return Window(col0, row0, max(col1 - col0, 0), max(row1 - row0, 0))
+
+
+def RasterTransform(raster):
+    """Affine transform (rasterio) of the upper-left corner and cell size of an arcpy Raster"""
+    return rasterio.transform.from_origin(raster.extent.XMin, raster.extent.YMax, raster.meanCellWidth, raster.meanCellHeight)
+
+
+def ReadArcpyTile(raster, readWindow, clipGeoms):
+    """ArcPy counterpart of ReadTile for rasters GDAL cannot open, such as mosaic datasets"""
+    transform = rasterio.windows.transform(readWindow, RasterTransform(raster))
+    lowerLeft = arcpy.Point(*(transform * (0, readWindow.height)))
+    CHM_Tile = arcpy.RasterToNumPyArray(raster, lowerLeft, readWindow.width, readWindow.height, nodata_to_value = np.nan).astype(np.float32)
+    return MaskOutside(CHM_Tile, clipGeoms, transform)
+
+
+def ProcessChm(chm, clipWindow, blockShape, clipGeoms, smooth, convert, minHt):
+    """Run ProcessTile over halo-overlapped CHM tiles in parallel and mosaic the tile interiors into full-size arrays
+
+    chm is either a path GDAL can read, in which case each tile is read by the process that works
+    on it, or an arcpy Raster, which is read here tile by tile. Tiles are whole multiples of the
+    on-disk blocks (unless a block is larger than TILE_SIZE) and their edges fall on block edges,
+    so reads decode each block once; the halos reach 3 cells into the neighboring blocks.
+    """
+    shape = (clipWindow.height, clipWindow.width)
+    outputs = (np.empty(shape, np.float32), np.empty(shape, np.bool_), np.empty(shape, np.uint16))
+    blockRows, blockCols = blockShape
+    tileRows = TILE_SIZE // blockRows * blockRows if blockRows <= TILE_SIZE else TILE_SIZE
+    tileCols = TILE_SIZE // blockCols * blockCols if blockCols <= TILE_SIZE else TILE_SIZE
+    windows = TileWindows(*shape, tileRows, tileCols, clipWindow.row_off, clipWindow.col_off)
+    readWindows = [Window(clipWindow.col_off + haloCol0, clipWindow.row_off + haloRow0, haloCol1 - haloCol0, haloRow1 - haloRow0)
+                   for _, (haloRow0, haloRow1, haloCol0, haloCol1) in windows]
+    options = (repeat(smooth), repeat(convert), repeat(minHt))
+    if isinstance(chm, str):
+        task, args = ReadAndProcessTile, (repeat(chm), readWindows, repeat(clipGeoms), *options)
+    else:
+        task, args = ProcessTile, ((ReadArcpyTile(chm, readWindow, clipGeoms) for readWindow in readWindows), *options)
+
+    ## A single GPU works through the tiles in turn; on the CPU each tile gets its own process
+    results = map(task, *args) if GPU else MapTasks(task, len(windows), *args)
+    MosaicTiles(outputs, windows, results)
+    return outputs
+
+
+def MosaicTiles(outputs, windows, results):
+    """Copy the interior (halo removed) of each tile result into the full-size output arrays"""
+    for ((row0, row1, col0, col1), (haloRow0, _, haloCol0, _)), tileOutputs in zip(windows, results):
+        for output, tileOutput in zip(outputs, tileOutputs):
+            output[row0:row1, col0:col1] = tileOutput[row0 - haloRow0:row1 - haloRow0, col0 - haloCol0:col1 - haloCol0]
+
+
+@numba.njit(cache = True)
+def BucketPush(head, tail, nxt, level, cell):
+    """Append cell to the FIFO for level in a bucket queue stored as per-level linked lists"""
+    if tail[level] == -1:
+        head[level] = cell
+    else:
+        nxt[tail[level]] = cell
+    tail[level] = cell
+
+
+@numba.njit(cache = True)
+def FloodWatershed(surface, markers, mask, nxt):
+    """Marker-controlled watershed of an integer surface by priority flood (Beucher-Meyer)
+
+    Cells are flooded from the markers in descending order of surface level, which is the
+    same as flooding the inverted surface from its minima, using a bucket queue with one
+    FIFO per level so each push and pop is O(1). nxt holds the queue links, one per cell,
+    filled with -1. Unreached cells are labeled 0.
+    """
+    nRows, nCols = surface.shape
+    nLevels = surface.max() + 1
+    labels = markers.copy()
+    head = np.full(nLevels, -1, dtype = np.int64)
+    tail = np.full(nLevels, -1, dtype = np.int64)
+
+    ## Queue the markers in raster order
+    for i in range(nRows):
+        for j in range(nCols):
+            if markers[i, j] > 0 and mask[i, j]:
+                BucketPush(head, tail, nxt, surface[i, j], i * nCols + j)
+
+    ## The current level only descends; neighbors above it are queued at the current level
+    level = nLevels - 1
+    while level >= 0:
+        cell = head[level]
+        if cell == -1:
+            level -= 1
+            continue
+        head[level] = nxt[cell]
+        if head[level] == -1:
+            tail[level] = -1
+        i, j = cell // nCols, cell % nCols
+        for ni in range(max(i - 1, 0), min(i + 2, nRows)):
+            for nj in range(max(j - 1, 0), min(j + 2, nCols)):
+                if mask[ni, nj] and labels[ni, nj] == 0:
+                    labels[ni, nj] = labels[i, j]
+                    BucketPush(head, tail, nxt, min(surface[ni, nj], level), ni * nCols + nj)
+    return labels
+
+
+def SegmentCanopy(CHM_Ft, CHM_Q, treeTopIds, treeTopHtLut, cellSize, maxDist = 40):
+    """Segment tree crowns from tree top IDs, returning a raster array of TreeId (0 = not canopy)
+
+    treeTopHtLut holds each tree top's height at index TreeId (index 0 = no tree).
+    """
+    valid = ~np.isnan(CHM_Ft)
+
+    ## Watersheds of the quantized canopy height, flooded downhill in memory from the tree tops;
+    ## the queue links are int32 unless the cell indices need more
+    nxt = np.full(CHM_Q.size, -1, dtype = np.int32 if CHM_Q.size < 2 ** 31 else np.int64)
+    CHM_Watershed = FloodWatershed(CHM_Q, treeTopIds, valid, nxt)
+    del nxt
+
+    ## Euclidean allocation tile by tile (the nearest tree top's row/column gives its ID), removing null conditions in the
+    ## same pass; a halo of maxDist keeps every tree top near enough to pass the distance test in view
+    CanopySeg = np.zeros(CHM_Ft.shape, dtype = np.int32)
+    for (row0, row1, col0, col1), (haloRow0, haloRow1, haloCol0, haloCol1) in TileWindows(*CHM_Ft.shape, halo = int(np.ceil(maxDist / cellSize)) + 1):
+        haloIds = treeTopIds[haloRow0:haloRow1, haloCol0:haloCol1]
+        if not haloIds.any():
+            continue
+        treeTopDist, (allocRow, allocCol) = ndimage.distance_transform_edt(haloIds == 0, return_indices = True)
+        tile = np.s_[row0 - haloRow0:row1 - haloRow0, col0 - haloCol0:col1 - haloCol0]
+        CanopySeg[row0:row1, col0:col1] = MaskCanopy(CHM_Ft[row0:row1, col0:col1], CHM_Watershed[row0:row1, col0:col1], haloIds,
+                                                     allocRow[tile], allocCol[tile], treeTopDist[tile], treeTopHtLut, cellSize, maxDist)
+    return CanopySeg
+
+
+@numba.njit(parallel = True, fastmath = FASTMATH, cache = True)
+def MaskCanopy(CHM_Ft, CHM_Watershed, treeTopIds, allocRow, allocCol, treeTopDist, treeTopHtLut, cellSize, maxDist):
+    """Label each cell with its allocated TreeId where the watershed agrees and no null condition applies, else 0
+
+    Fuses the allocation lookup, the watershed = allocation test, and the Alloc Dist GT 60% Tree
+    Height and CHM GT 30% Tree Height null conditions into one pass without intermediate rasters.
+    treeTopDist is in cells and is scaled to map units here.
+    """
+    nRows, nCols = CHM_Ft.shape
+    CanopySeg = np.empty((nRows, nCols), dtype = np.int32)
+    for i in numba.prange(nRows):
+        for j in range(nCols):
+            ht = CHM_Ft[i, j]
+            dist = treeTopDist[i, j] * cellSize
+            treeTopAlloc = treeTopIds[allocRow[i, j], allocCol[i, j]]
+            ## dist is already in map units; the second cellSize in the 60% test is kept on purpose for parity with the
+            ## baseline's (treeTopDist * Resolution * 3.281 * 0.6), whose EucAllocation distance was in map units too
+            keep = ((ht == ht) & (dist <= maxDist) & (treeTopAlloc > 0) & (CHM_Watershed[i, j] == treeTopAlloc)
+                    & (dist * cellSize * FT_PER_M * 0.6 <= ht) & (treeTopHtLut[treeTopAlloc] * 0.3 <= ht))
+            CanopySeg[i, j] = treeTopAlloc if keep else 0
+    return CanopySeg
+
+
+def TreeTopTable(treeLoc, CHM_Ft, transform):
+    """Tabulate tree tops (TreeId, Height, x, y) at the cell centers of the seed mask, numbered by TreeId in raster order"""
+    treeTopRow, treeTopCol = np.nonzero(treeLoc)
+    x, y = transform * (treeTopCol + 0.5, treeTopRow + 0.5)
+    return pd.DataFrame({
+        "TreeId": np.arange(1, treeTopRow.size + 1, dtype = np.int32),
+        "Height": CHM_Ft[treeTopRow, treeTopCol],
+        "x": x,
+        "y": y})
+
+
+def PolygonizeCanopy(CanopySegArr, transform, spatialRef, tolerance = 2, minArea = 1):
+    """Trace canopy segments into simplified polygons (tolerance in m, minArea in sq m), returning a GeoDataFrame with a TreeId column"""
+
+    ## One core traces the whole array in a single pass; several trace bands of rows in parallel
+    if os.cpu_count() < 2:
+        segShapes = TraceSegments(CanopySegArr, CanopySegArr > 0, transform)
+    else:
+        crops, masks, transforms = SegmentBands(CanopySegArr, transform)
+        segShapes = [segShape for bandShapes in MapTasks(TraceSegments, len(crops), crops, masks, transforms) for segShape in bandShapes]
+    treeIds = np.array([value for _, value in segShapes], dtype = np.int32)
+    geoms = np.array([geom for geom, _ in segShapes], dtype = object)
+
+    ## Simplify (Douglas-Peucker) and smooth (Chaikin) in map units, dropping small holes, in one pass over the polygons
+    minArea /= spatialRef.metersPerUnit ** 2
+    geoms = shapely.simplify(geoms, tolerance / spatialRef.metersPerUnit, preserve_topology = True)
+    geoms = np.array([SmoothPolygon(geom, minArea) for geom in geoms], dtype = object)
+    invalid = ~shapely.is_valid(geoms)
+    geoms[invalid] = [PolygonalParts(geom) for geom in shapely.make_valid(geoms[invalid])]
+
+    ## Drop collapsed segments
+    keep = shapely.area(geoms) >= minArea
+    return gpd.GeoDataFrame({"TreeId": treeIds[keep]}, geometry = geoms[keep], crs = CrsFromSpatialReference(spatialRef))
+
+
+def SegmentBands(CanopySegArr, transform):
+    """Group segments into bands of SEGMENT_BAND rows by the top of their bounding box, returning each band's crop, mask, and transform
+
+    Each band's crop spans its segments' full extent, so no segment is split between bands.
+    """
+    boxes = ndimage.find_objects(CanopySegArr)
+    segBand = np.array([-1] + [box[0].start // SEGMENT_BAND if box is not None else -1 for box in boxes])
+    segBottom = np.array([0] + [box[0].stop if box is not None else 0 for box in boxes])
+    bandRows = [(band * SEGMENT_BAND, segBottom[segBand == band].max()) for band in np.unique(segBand[segBand >= 0])]
+    crops = [CanopySegArr[row0:row1] for row0, row1 in bandRows]
+    masks = [segBand[crop] == row0 // SEGMENT_BAND for crop, (row0, _) in zip(crops, bandRows)]
+    transforms = [transform * rasterio.transform.Affine.translation(0, row0) for row0, _ in bandRows]
+    return crops, masks, transforms
+
+
+def ChaikinRing(coords):
+    """One level of Chaikin corner cutting on the coordinates of a closed ring"""
+    points = coords[:-1]
+    nextPoints = np.roll(points, -1, axis = 0)
+    cut = np.empty((2 * len(points) + 1, 2))
+    cut[0:-1:2] = 0.75 * points + 0.25 * nextPoints
+    cut[1:-1:2] = 0.25 * points + 0.75 * nextPoints
+    cut[-1] = cut[0]
+    return cut
+
+
+def SmoothPolygon(polygon, minHoleArea):
+    """Chaikin-smooth a polygon's rings, dropping interior holes smaller than minHoleArea (map units)"""
+    if polygon.is_empty:
+        return polygon
+    holes = [ChaikinRing(np.asarray(ring.coords)[:, :2]) for ring in polygon.interiors if Polygon(ring).area >= minHoleArea]
+    return Polygon(ChaikinRing(np.asarray(polygon.exterior.coords)[:, :2]), holes)
+
+
+def PolygonalParts(geom):
+    """MultiPolygon of the polygons in a make_valid result, dropping the line and point parts left where rings touched"""
+    parts = shapely.get_parts(shapely.get_parts(geom))
+    return shapely.multipolygons(parts[shapely.get_type_id(parts) == shapely.GeometryType.POLYGON])
+
+
+def CrsFromSpatialReference(spatialRef):
+    """Convert an arcpy SpatialReference to a CRS definition accepted by geopandas"""
+    if spatialRef.factoryCode:
+        return "EPSG:{}".format(spatialRef.factoryCode)
+    return spatialRef.exportToString().split(";")[0]
+
+
+def WriteFeatures(gdf, workspace, name, driver, **options):
+    """Write a GeoDataFrame to a file geodatabase feature class or a shapefile in workspace with GDAL (pyogrio)"""
+    if driver == "OpenFileGDB":
+        pyogrio.write_dataframe(gdf, workspace, layer = name, driver = driver, **options)
+    else:
+        pyogrio.write_dataframe(gdf, os.path.join(workspace, name), driver = driver, **options)
+
+
+def SaveArrayAsRaster(arr, transform, spatialRef, outRaster, nodata = np.nan):
+    """Save a NumPy array straight to outRaster at the (north-up) affine transform and spatial reference given"""
+    lowerLeft = arcpy.Point(transform.c, transform.f + transform.e * arr.shape[0])
+    arcpy.NumPyArrayToRaster(arr, lowerLeft, transform.a, -transform.e, value_to_nodata = nodata).save(outRaster)
+    arcpy.management.DefineProjection(outRaster, spatialRef)
 
 
 def ScriptTool(parameter0, parameter1, parameter2, parameter3, parameter4, parameter5):
     """ScriptTool function docstring"""
-    CHM_Ext = arcpy.sa.ExtractByMask(in_raster = parameter0, in_mask_data = parameter1)
+    ## Read the CHM with GDAL (rasterio) where it can open it; otherwise (e.g. mosaic datasets, or File GDB rasters before GDAL 3.7) through ArcPy
+    chmDesc = arcpy.Describe(parameter0)
+    spatialRef = chmDesc.spatialReference
+    try:
+        with rasterio.open(chmDesc.catalogPath) as src:
+            chm, chmTransform, chmShape, blockShape = chmDesc.catalogPath, src.transform, src.shape, src.block_shapes[0]
+    except rasterio.errors.RasterioIOError:
+        chm = arcpy.Raster(parameter0)
+        chmTransform, chmShape, blockShape = RasterTransform(chm), (chm.height, chm.width), (1, 1)
+
+    ## Clip the CHM to the window around the clipping features; cells outside them are masked as tiles are read
+    with arcpy.da.SearchCursor(parameter1, ["SHAPE@WKB"], spatial_reference = spatialRef) as cursor:
+        clipGeoms = [shapely.from_wkb(bytes(wkb)) for wkb, in cursor]
+    clipWindow = ClipWindow(chmTransform, chmShape, shapely.total_bounds(clipGeoms))
+    transform = rasterio.windows.transform(clipWindow, chmTransform)
     arcpy.AddMessage("Clipped canopy height model")
     
     ## Smooth CHM if desired
-    if parameter2.lower() == 'true':
-        CHM_Sm = arcpy.sa.FocalStatistics(in_raster=CHM_Ext, neighborhood= "Rectangle 3 3 CELL", statistics_type= "Mean", ignore_nodata="DATA", percentile_value=90)
-        arcpy.AddMessage("Smoothed canopy height model")
-    else:
-        CHM_Sm = CHM_Ext
+    smooth = parameter2.lower() == 'true'
     
     ## Convert CHM to feet if necessary
-    if parameter3.lower() == 'true':
-        CHM_Ft = CHM_Sm * 3.281
-        arcpy.AddMessage("Converted canopy heights from m to ft")
-    else:
-        CHM_Ft = CHM_Sm
+    convert = parameter3.lower() == 'true'
     
-    ## Set minimum tree height 
-    CHM_MinHt = arcpy.sa.SetNull(CHM_Ft, CHM_Ft, "VALUE < " + parameter4)
+    ## Smooth, convert units, set minimum tree height, and find local maximum = CHM tile by tile
+    CHM_FtArr, treeLocArr, CHM_QArr = ProcessChm(chm, clipWindow, blockShape, clipGeoms, smooth, convert, float(parameter4))
+    if GPU:
+        arcpy.AddMessage("Processed canopy height model on the GPU")
+    if smooth:
+        arcpy.AddMessage("Smoothed canopy height model")
+    if convert:
+        arcpy.AddMessage("Converted canopy heights from m to ft")
     arcpy.AddMessage("Set minimum tree height")
     
-    ## Calculate local maxima
-    CHM_LocalMax = arcpy.sa.FocalStatistics(in_raster = CHM_MinHt, neighborhood = "Rectangle 5 5 CELL", statistics_type = "MAXIMUM", ignore_nodata = "DATA", percentile_value = 90)
-    
-    ## Local maximum = CHM
-    treeLoc = arcpy.sa.EqualTo(in_raster_or_constant1 = CHM_LocalMax, in_raster_or_constant2 = CHM_MinHt)
-    
-    ## Isolate tree tops
-    treeLocHt = arcpy.sa.SetNull(in_conditional_raster = treeLoc, in_false_raster_or_constant = CHM_MinHt, where_clause = "Value = 0")
-    
-    ## Raster to point
-    treeTop = arcpy.conversion.RasterToPoint(in_raster = treeLocHt, out_point_features = "treeTop", raster_field = "Value")
+    ## Tree top attribute table straight from the seed mask
+    treeTopAttr = TreeTopTable(treeLocArr, CHM_FtArr, transform)
     arcpy.AddMessage("Identified tree tops")
-
-    ## Rename tree top columns
-    treeTop = arcpy.management.AlterField(in_table = treeTop, field = "grid_code", new_field_name = "Height", new_field_alias = "Height (ft)")[0]
-    treeTop = arcpy.management.AlterField(in_table = treeTop, field = "pointid", new_field_name = "TreeId", new_field_alias = "TreeId")[0]
-    
-    ## Reclass tree points to ID number
-    treeTopReclass = arcpy.sa.ReclassByTable(in_raster = treeLocHt, in_remap_table = treeTop, from_value_field = "Height", to_value_field = "Height", output_value_field = "TreeId", missing_values = "DATA")
-    
-    ## Eulidean allocation
-    treeTopAlloc = arcpy.sa.EucAllocation(in_source_data = treeTopReclass, source_field = "VALUE", maximum_distance = 40, out_distance_raster = "treeTopDist")
-    treeTopDist = arcpy.Raster("treeTopDist")
-    
-    ## Create inverse CHM
-    CHM_Inv = abs(1000 - CHM_Ft)
     
-    ## Create flow direction raster
-    CHM_Flow = arcpy.sa.FlowDirection(in_surface_raster = CHM_Inv, force_flow = "NORMAL", flow_direction_type="D8")
-    
-    ## Create watersheds from inverted canopy height
-    CHM_watershed = arcpy.sa.Watershed(in_flow_direction_raster = CHM_Flow, in_pour_point_data = treeTopReclass, pour_point_field="VALUE")
-    arcpy.AddMessage("Created watersheds from inverted canopy height")
+    ## Rasterize tree top IDs (boolean indexing visits cells in the same raster order as TreeId)
+    treeTopIds = np.zeros(CHM_FtArr.shape, dtype = np.int32)
+    treeTopIds[treeLocArr] = treeTopAttr["TreeId"].to_numpy()
 
-    ## Build attibute table
-    #treeTopAlloc = arcpy.management.BuildRasterAttributeTable(in_raster = treeTopAlloc, overwrite="NONE")[0]
+    ## Tree top height lookup table indexed by TreeId
+    treeTopHtLut = np.concatenate(([0], treeTopAttr["Height"].to_numpy())).astype(np.float32)
 
-    ## Watershed Equal To Tree ID
-    CHM_WsEqAlloc = arcpy.sa.EqualTo(in_raster_or_constant1 = CHM_watershed, in_raster_or_constant2 = treeTopAlloc)
-    
-    ## Get Raster Resolution
-    Resolution = arcpy.management.GetRasterProperties(in_raster=CHM_Ft, property_type="CELLSIZEX", band_index="")[0]
-    
-    ## Alloc Dist GT 60% Tree Height (Raster Calculator)
-    DistGT60Hmax = (treeTopDist * float(Resolution) * 3.281 * 0.6) > CHM_Ft
+    ## Segment canopy and remove null conditions
+    CanopySegArr = SegmentCanopy(CHM_FtArr, CHM_QArr, treeTopIds, treeTopHtLut, transform.a)
+    arcpy.AddMessage("Created watersheds from canopy height")
     
-    ## Join height to treeTopAlloc
-    treeTopAlloc = arcpy.management.JoinField(in_data = treeTopAlloc, in_field = "Value", join_table = treeTop, join_field = "TreeId", fields = ["Height"])[0]
+    ## Canopy Segmentation raster to simplified polygons
+    CanopySeg = PolygonizeCanopy(CanopySegArr, transform, spatialRef)
+    arcpy.AddMessage("Created and simplified canopy segmentation polygons")
     
-    ## treeTopAlloc by height instead of ID
-    treeTopAllocHt = arcpy.sa.Lookup(in_raster = treeTopAlloc, lookup_field = "Height")
-
-    ## CHM GT 30% Tree Height
-    Htmx30GTCHM =  (treeTopAllocHt * 0.3) >  CHM_Ft
-    
-    ## Add Segmentation null conditions
-    SegNull = DistGT60Hmax + Htmx30GTCHM
-    
-    ## Remove null conditions
-    CanopySegRas = arcpy.sa.SetNull(CHM_WsEqAlloc - SegNull, treeTopAlloc, "VALUE < 1")
-    
-    ## Canopy Segmentation raster to polygon
-    CanopySeg = arcpy.conversion.RasterToPolygon(in_raster = CanopySegRas, simplify = "SIMPLIFY", raster_field = "Value", create_multipart_features = "SINGLE_OUTER_PART", max_vertices_per_feature = None)
-    arcpy.AddMessage("Created canopy segmentations")
-    
-    ## Simplify Polygon
-    CanopySeg_Simp = arcpy.cartography.SimplifyPolygon(in_features = CanopySeg, out_feature_class = "in_memory/CanopySeg_Simp", algorithm = "WEIGHTED_AREA", tolerance = "2 Meters", minimum_area = "1 SquareMeters", error_option = "RESOLVE_ERRORS", collapsed_point_option = "NO_KEEP")[0]
-    
-    ## Smooth Polygon
-    CanopySegmentation = arcpy.cartography.SmoothPolygon(in_features = CanopySeg_Simp, algorithm = "BEZIER_INTERPOLATION", error_option = "FLAG_ERRORS")
-    arcpy.AddMessage("Simplified and smoothed canopy segmentation polygons")
-    
-    ## Join, delete, and rename Canopy Seg attribute fields
-    CanopySegmentation = arcpy.management.JoinField(in_data = CanopySegmentation, in_field = "gridcode", join_table = treeTop, join_field = "TreeId", fields = ["Height"])[0]
-    CanopySegmentation = arcpy.DeleteField_management(CanopySegmentation, ['Id', 'InPoly_FID', 'SimPgnFlag', 'MaxSimpTol', 'MinSimpTol', 'SmoPgnFlag'])
-    CanopySegmentation = arcpy.management.AlterField(in_table = CanopySegmentation, field = "gridcode", new_field_name = "TreeId", new_field_alias = "TreeId")[0]
-    CanopySegmentation = arcpy.management.AlterField(in_table = CanopySegmentation, field = "Height", new_field_name = "Height", new_field_alias = "Height (ft)")[0]
+    ## Final feature schemas: tree top points, and Canopy Seg with tree top height merged in
+    treeTop = gpd.GeoDataFrame(treeTopAttr[["TreeId", "Height"]], geometry = gpd.points_from_xy(treeTopAttr["x"], treeTopAttr["y"]), crs = CanopySeg.crs)
+    CanopySegmentation = CanopySeg.merge(treeTopAttr[["TreeId", "Height"]], on = "TreeId", how = "left", validate = "many_to_one")
 
     ## Save tree points, canopy segmentation, and canopy height model to desired output location
     if parameter5[-4:] == ".gdb":
         rasterName = arcpy.ValidateTableName("CanopyHeight", parameter5)
         treeTopName = arcpy.ValidateTableName("TreeTop", parameter5)
         canopySegName = arcpy.ValidateTableName("CanopySegmentation", parameter5)
+        vectorDriver = "OpenFileGDB"
     else:
         rasterName = arcpy.ValidateTableName("CanopyHeight.tif", parameter5)
         treeTopName = arcpy.ValidateTableName("TreeTop.shp", parameter5)
         canopySegName = arcpy.ValidateTableName("CanopySegmentation.shp", parameter5)
+        vectorDriver = "ESRI Shapefile"
 
     outRaster = os.path.join(parameter5, rasterName)
-    outTreeTop = os.path.join(parameter5, treeTopName)
-    outCanopySeg = os.path.join(parameter5, canopySegName)
 
-    arcpy.management.CopyRaster(CHM_Ft, outRaster)
-    arcpy.management.CopyFeatures(treeTop, outTreeTop)
-    arcpy.management.CopyFeatures(CanopySegmentation, outCanopySeg)
+    SaveArrayAsRaster(CHM_FtArr, transform, spatialRef, outRaster)
+    WriteFeatures(treeTop, parameter5, treeTopName, vectorDriver)
+    WriteFeatures(CanopySegmentation, parameter5, canopySegName, vectorDriver, geometry_type = "MultiPolygon", promote_to_multi = True)
+
+    ## GDAL does not write field aliases; restore the "Height (ft)" alias on geodatabase outputs (shapefiles have none)
+    if vectorDriver == "OpenFileGDB":
+        for featureName in (treeTopName, canopySegName):
+            arcpy.management.AlterField(in_table = os.path.join(parameter5, featureName), field = "Height", new_field_alias = "Height (ft)")
     arcpy.AddMessage("Saved files to workspace")
 
 if __name__ == '__main__':
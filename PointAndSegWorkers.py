@@ -0,0 +1,207 @@
+"""
+Source Name:        <PointAndSegWorkers>
+Description:        <Numba and CuPy kernels for PointAndSeg, and the CHM tile and canopy trace tasks its process pools run.
+                     Kept free of arcpy so spawned workers import only what the tasks need.>
+"""
+import numba
+import numpy as np
+import rasterio
+from rasterio import features
+from shapely.geometry import shape
+
+## CuPy is optional; focal statistics run on the GPU when a CUDA device is available
+try:
+    import cupy
+    from cupyx.scipy import ndimage as cupyx_ndimage
+    GPU = cupy.is_available()
+except ImportError:
+    cupy = None
+    GPU = False
+
+## Fast-math flags for the fused kernels; "nnan"/"ninf" are left out because NoData is carried as NaN
+FASTMATH = {"nsz", "arcp", "contract", "afn", "reassoc"}
+
+## Feet per meter for the m to ft conversion
+FT_PER_M = 3.281
+
+## Quantized CHM levels per foot (uint16 holds 0.1 ft steps up to 6553 ft)
+HT_LEVELS = 10
+
+
+def ToHost(arr):
+    """Copy a GPU array back to host memory; NumPy arrays are returned unchanged"""
+    return cupy.asnumpy(arr) if cupy is not None else arr
+
+
+@numba.njit(inline = "always")
+def NanToZero(value):
+    """Return value, or 0 if it is NoData (NaN)"""
+    return value if value == value else np.float32(0)
+
+
+@numba.njit(parallel = True, fastmath = FASTMATH, cache = True)
+def RowSum3x1(arr):
+    """Row pass of the separable 3x3 focal mean: 3-tap sums and counts of non-NoData (NaN) cells
+
+    Runs unrolled over a NaN-padded copy so the inner loop has no edge checks; the outputs keep
+    the padding rows, so the column pass can read rows i to i + 2 for output row i.
+    """
+    nRows, nCols = arr.shape
+    padded = np.full((nRows + 2, nCols + 2), np.nan, dtype = np.float32)
+    padded[1:-1, 1:-1] = arr
+    rowSum = np.empty((nRows + 2, nCols), dtype = np.float32)
+    rowCount = np.empty((nRows + 2, nCols), dtype = np.float32)
+    for i in numba.prange(nRows + 2):
+        for j in range(nCols):
+            a, b, c = padded[i, j], padded[i, j + 1], padded[i, j + 2]
+            rowSum[i, j] = NanToZero(a) + NanToZero(b) + NanToZero(c)
+            rowCount[i, j] = np.float32(a == a) + np.float32(b == b) + np.float32(c == c)
+    return rowSum, rowCount
+
+
+def Mean3x3Gpu(arr):
+    """GPU 3x3 focal mean that ignores NoData, using cupyx.scipy.ndimage"""
+    valid = ~cupy.isnan(arr)
+    total = cupyx_ndimage.uniform_filter(cupy.where(valid, arr, 0), size = 3, mode = "constant", cval = 0)
+    count = cupyx_ndimage.uniform_filter(valid.astype(cupy.float32), size = 3, mode = "constant", cval = 0)
+    return cupy.where(count > 0, total / count, cupy.nan).astype(cupy.float32)
+
+
+def FindTreeTopsGpu(CHM_Ft, minHt):
+    """GPU counterpart of FindTreeTops using cupyx.scipy.ndimage and an element-wise seed test
+
+    The GPU filter runs on the float heights directly (NoData as -inf), so there are no quantized ties to break.
+    """
+    CHM_LocalMax = cupyx_ndimage.maximum_filter(cupy.nan_to_num(CHM_Ft, nan = -cupy.inf), size = 5, mode = "constant", cval = -cupy.inf)
+    return TreeTopMaskGpu(CHM_Ft, CHM_LocalMax, minHt)
+
+
+def MakeQuantizeChm(smooth, convert):
+    """Build the QuantizeChm kernel variant for one (smooth, convert) pair of tool options
+
+    smooth and convert are constants of the closure, so Numba compiles the unused steps out and
+    the inner loop has no per-cell branch on them. With smoothing, the column pass of the 3x3
+    focal mean (like FocalStatistics with DATA ignore_nodata), the m to ft conversion, and the
+    quantization run in one pass over the tile.
+    """
+    convFactor = np.float32(FT_PER_M)
+
+    @numba.njit(parallel = True, fastmath = FASTMATH, cache = True)
+    def QuantizeChm(CHM_Tile):
+        """Smooth and convert heights as configured and quantize them to uint16 levels of 1 / HT_LEVELS ft (NoData = 0), keeping a float32 copy"""
+        nRows, nCols = CHM_Tile.shape
+        if smooth:
+            rowSum, rowCount = RowSum3x1(CHM_Tile)
+        CHM_Ft = np.empty((nRows, nCols), dtype = np.float32)
+        CHM_Q = np.empty((nRows, nCols), dtype = np.uint16)
+        for i in numba.prange(nRows):
+            for j in range(nCols):
+                if smooth:
+                    total = rowSum[i, j] + rowSum[i + 1, j] + rowSum[i + 2, j]
+                    count = rowCount[i, j] + rowCount[i + 1, j] + rowCount[i + 2, j]
+                    ht = total / count if count > 0 else np.float32(np.nan)
+                else:
+                    ht = CHM_Tile[i, j]
+                if convert:
+                    ht = ht * convFactor
+                CHM_Ft[i, j] = ht
+                CHM_Q[i, j] = np.uint16(min(max(np.floor(ht * HT_LEVELS + 0.5), 0), 65535)) if ht == ht else 0
+        return CHM_Ft, CHM_Q
+
+    return QuantizeChm
+
+
+## QuantizeChm variants keyed by (smooth, convert); each compiles on first use
+QuantizeChmVariants = {(smooth, convert): MakeQuantizeChm(smooth, convert) for smooth in (False, True) for convert in (False, True)}
+
+
+@numba.njit(parallel = True, fastmath = FASTMATH, cache = True)
+def FindTreeTops(CHM_Ft, CHM_Q, minHt):
+    """Flag cells that equal their 5x5 focal maximum and are at or above the minimum height
+
+    The max runs over the unmasked quantized CHM: a neighbor below minHt is also below any center
+    that passes the height test, so the seeds match a masked max while the loops stay branch-free.
+    The max is two unrolled 5-tap passes (row, then column) over a zero-padded copy, and the seed
+    test runs in the column pass so the focal max is never stored. Neighbors within one level of
+    the peak quantize to the same value, so candidates are confirmed against the float heights
+    (NoData neighbors are ignored) and the seeds match a float 5x5 focal max.
+    """
+    nRows, nCols = CHM_Q.shape
+    padded = np.zeros((nRows + 4, nCols + 4), dtype = CHM_Q.dtype)
+    padded[2:-2, 2:-2] = CHM_Q
+    rowMax = np.empty((nRows + 4, nCols), dtype = CHM_Q.dtype)
+    for i in numba.prange(nRows + 4):
+        for j in range(nCols):
+            rowMax[i, j] = max(max(max(padded[i, j], padded[i, j + 1]), max(padded[i, j + 2], padded[i, j + 3])), padded[i, j + 4])
+    treeLoc = np.empty(CHM_Q.shape, dtype = np.bool_)
+    for i in numba.prange(nRows):
+        for j in range(nCols):
+            localMax = max(max(max(rowMax[i, j], rowMax[i + 1, j]), max(rowMax[i + 2, j], rowMax[i + 3, j])), rowMax[i + 4, j])
+            ## Bitwise & keeps the seed test branch-free so the row loop vectorizes
+            treeLoc[i, j] = (localMax == CHM_Q[i, j]) & (CHM_Ft[i, j] >= minHt)
+
+    ## Break quantized ties on the float heights; candidates are rare, so this loop is cheap
+    for i in numba.prange(nRows):
+        for j in range(nCols):
+            if treeLoc[i, j]:
+                for ni in range(max(i - 2, 0), min(i + 3, nRows)):
+                    for nj in range(max(j - 2, 0), min(j + 3, nCols)):
+                        if CHM_Ft[ni, nj] > CHM_Ft[i, j]:
+                            treeLoc[i, j] = False
+    return treeLoc
+
+
+## GPU counterparts of the QuantizeChm variants and the FindTreeTops seed test; CuPy launches each as one element-wise kernel
+if cupy is not None:
+    QuantizeChmGpu = cupy.ElementwiseKernel(
+        "float32 CHM_Sm, float32 convFactor",
+        "float32 CHM_Ft, uint16 CHM_Q",
+        """
+        float ht = CHM_Sm * convFactor;
+        CHM_Ft = ht;
+        CHM_Q = isnan(ht) ? 0 : (unsigned short)fminf(fmaxf(floorf(ht * {levels}.0f + 0.5f), 0.0f), 65535.0f);
+        """.format(levels = HT_LEVELS),
+        "QuantizeChmGpu")
+
+    TreeTopMaskGpu = cupy.ElementwiseKernel(
+        "float32 CHM_Ft, float32 CHM_LocalMax, float32 minHt",
+        "bool treeLoc",
+        "treeLoc = (CHM_LocalMax == CHM_Ft) & (CHM_Ft >= minHt)",
+        "TreeTopMaskGpu")
+
+
+def ProcessTile(CHM_Tile, smooth, convert, minHt):
+    """Smooth, convert, quantize, threshold, and find local maxima on one CHM tile (on the GPU if available)"""
+    if GPU:
+        CHM_Tile = cupy.asarray(CHM_Tile)
+        CHM_Sm = Mean3x3Gpu(CHM_Tile) if smooth else CHM_Tile
+        CHM_Ft, CHM_Q = QuantizeChmGpu(CHM_Sm, np.float32(FT_PER_M if convert else 1.0))
+        treeLoc = FindTreeTopsGpu(CHM_Ft, np.float32(minHt))
+    else:
+        CHM_Ft, CHM_Q = QuantizeChmVariants[smooth, convert](CHM_Tile)
+        treeLoc = FindTreeTops(CHM_Ft, CHM_Q, np.float32(minHt))
+    return ToHost(CHM_Ft), ToHost(treeLoc), ToHost(CHM_Q)
+
+
+def ReadAndProcessTile(chmPath, readWindow, clipGeoms, smooth, convert, minHt):
+    """Read one CHM tile with GDAL and run ProcessTile on it, so the tile is never sent between processes"""
+    return ProcessTile(ReadTile(chmPath, readWindow, clipGeoms), smooth, convert, minHt)
+
+
+def ReadTile(chmPath, readWindow, clipGeoms):
+    """Read a window of the CHM with GDAL (rasterio) into a float32 array with NoData and cells outside clipGeoms as NaN"""
+    with rasterio.open(chmPath) as src:
+        CHM_Tile = src.read(1, window = readWindow, masked = True).astype(np.float32).filled(np.nan)
+        return MaskOutside(CHM_Tile, clipGeoms, src.window_transform(readWindow))
+
+
+def MaskOutside(CHM_Tile, clipGeoms, transform):
+    """Set cells of a CHM tile whose centers fall outside clipGeoms to NaN (NoData), like ExtractByMask"""
+    inside = features.geometry_mask(clipGeoms, CHM_Tile.shape, transform, invert = True)
+    CHM_Tile[~inside] = np.nan
+    return CHM_Tile
+
+
+def TraceSegments(CanopySegArr, mask, transform):
+    """Trace polygons (with their TreeId) for the masked segments of a band of the canopy segmentation array"""
+    return [(shape(geom), int(value)) for geom, value in features.shapes(CanopySegArr, mask = mask, transform = transform)]